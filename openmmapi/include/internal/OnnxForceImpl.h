@@ -57,12 +57,22 @@ public:
 private:
     const OnnxForce& owner;
     void validateInput(const std::string& name, const std::vector<int>& shape, int size);
+    Ort::Value createDeviceTensor(const Ort::Value& tensor);
+    void copyTensor(Ort::Value& dest, Ort::Value& source);
+    void synchronizeDevice();
     Ort::Env env;
     Ort::Session session;
-    std::vector<Ort::Value> inputTensors, outputTensors;
+    Ort::Allocator pinnedAllocator, deviceAllocator;
+    Ort::IoBinding binding;
+    Ort::RunOptions runOptions;
+    std::vector<Ort::Value> inputTensors, outputTensors, deviceInputTensors, deviceOutputTensors;
+    int numVaryingInputs;
+    bool useDeviceBuffers;
     std::vector<const char*> inputNames;
     std::vector<int> particleIndices;
-    std::vector<float> positionVec, paramVec;
+    bool allParticles;
+    std::vector<float> positionVec, paramVec, energyVec, forceVec;
+    float *positionData, *energyData, *forceData;
     std::vector<OnnxForce::IntegerInput> integerInputs;
     std::vector<OnnxForce::FloatInput> floatInputs;
     float boxVectors[9];
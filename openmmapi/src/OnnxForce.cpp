@@ -58,7 +58,8 @@ OnnxForce::~OnnxForce() {
 }
 
 void OnnxForce::initProperties(const std::map<std::string, std::string>& properties) {
-    const std::map<std::string, std::string> defaultProperties = {{"UseGraphs", "false"}, {"DeviceIndex", "0"}};
+    const std::map<std::string, std::string> defaultProperties = {{"UseGraphs", "false"}, {"DeviceIndex", "0"},
+            {"GraphOptimizationLevel", "all"}, {"EnableMemPattern", "true"}, {"IntraOpNumThreads", "0"}};
     this->properties = defaultProperties;
     for (auto& property : properties) {
         if (defaultProperties.find(property.first) == defaultProperties.end())
@@ -33,13 +33,17 @@
 #include "openmm/OpenMMException.h"
 #include "openmm/internal/ContextImpl.h"
 #include <sstream>
+#ifdef OPENMM_ONNX_BUILD_CUDA
+#include <cuda_runtime.h>
+#endif
 
 using namespace OnnxPlugin;
 using namespace OpenMM;
 using namespace std;
 using namespace Ort;
 
-OnnxForceImpl::OnnxForceImpl(const OnnxForce& owner) : CustomCPPForceImpl(owner), owner(owner), session(nullptr) {
+OnnxForceImpl::OnnxForceImpl(const OnnxForce& owner) : CustomCPPForceImpl(owner), owner(owner), session(nullptr), pinnedAllocator(nullptr),
+        deviceAllocator(nullptr), binding(nullptr) {
 }
 
 OnnxForceImpl::~OnnxForceImpl() {
@@ -51,7 +55,8 @@ void OnnxForceImpl::initialize(ContextImpl& context) {
     // Record which particles the force is applied to.
 
     particleIndices = owner.getParticleIndices();
-    if (particleIndices.size() == 0) {
+    allParticles = (particleIndices.size() == 0);
+    if (allParticles) {
         int numParticles = context.getSystem().getNumParticles();
         for (int i = 0; i < numParticles; i++)
             particleIndices.push_back(i);
@@ -69,6 +74,37 @@ void OnnxForceImpl::initialize(ContextImpl& context) {
     else
         throw OpenMMException("Illegal value for UseGraphs: "+owner.getProperties().at("UseGraphs"));
     SessionOptions options;
+    string optimizationLevel = owner.getProperties().at("GraphOptimizationLevel");
+    if (optimizationLevel == "disable")
+        options.SetGraphOptimizationLevel(ORT_DISABLE_ALL);
+    else if (optimizationLevel == "basic")
+        options.SetGraphOptimizationLevel(ORT_ENABLE_BASIC);
+    else if (optimizationLevel == "extended")
+        options.SetGraphOptimizationLevel(ORT_ENABLE_EXTENDED);
+    else if (optimizationLevel == "all")
+        options.SetGraphOptimizationLevel(ORT_ENABLE_ALL);
+    else
+        throw OpenMMException("Illegal value for GraphOptimizationLevel: "+optimizationLevel);
+    if (owner.getProperties().at("EnableMemPattern") == "true")
+        options.EnableMemPattern();
+    else if (owner.getProperties().at("EnableMemPattern") == "false")
+        options.DisableMemPattern();
+    else
+        throw OpenMMException("Illegal value for EnableMemPattern: "+owner.getProperties().at("EnableMemPattern"));
+    string threads = owner.getProperties().at("IntraOpNumThreads");
+    if (threads == "0" && context.getPlatform().getName() == "CPU") {
+        // Use the same number of threads as the CPU platform, so the two together do not
+        // oversubscribe the cores.
+
+        threads = context.getPlatform().getPropertyValue(context.getOwner(), "Threads");
+    }
+    int numThreads;
+    stringstream threadsStream(threads);
+    threadsStream >> numThreads;
+    if (threadsStream.fail() || !threadsStream.eof() || numThreads < 0)
+        throw OpenMMException("Illegal value for IntraOpNumThreads: "+threads);
+    options.SetIntraOpNumThreads(numThreads);
+    bool usesCuda = false, usesRocm = false;
     if (provider == OnnxForce::TensorRT || provider == OnnxForce::Default) {
         OrtTensorRTProviderOptionsV2* rtOptions = nullptr;
         if (GetApi().CreateTensorRTProviderOptions(&rtOptions) == nullptr) {
@@ -76,6 +112,7 @@ void OnnxForceImpl::initialize(ContextImpl& context) {
             vector<const char*> values{deviceIndex.c_str(), enableGraph.c_str()};
             ThrowOnError(GetApi().UpdateTensorRTProviderOptions(rtOptions, keys.data(), values.data(), 2));
             options.AppendExecutionProvider_TensorRT_V2(*rtOptions);
+            usesCuda = true;
         }
         else if (provider == OnnxForce::TensorRT)
             throw OpenMMException("TensorRT execution provider is not available");
@@ -87,6 +124,7 @@ void OnnxForceImpl::initialize(ContextImpl& context) {
             vector<const char*> values{deviceIndex.c_str(), "0", enableGraph.c_str()};
             ThrowOnError(GetApi().UpdateCUDAProviderOptions(cudaOptions, keys.data(), values.data(), 3));
             options.AppendExecutionProvider_CUDA_V2(*cudaOptions);
+            usesCuda = true;
         }
         else if (provider == OnnxForce::CUDA)
             throw OpenMMException("CUDA execution provider is not available");
@@ -98,25 +136,59 @@ void OnnxForceImpl::initialize(ContextImpl& context) {
             vector<const char*> values{deviceIndex.c_str(), enableGraph.c_str()};
             ThrowOnError(GetApi().UpdateROCMProviderOptions(rocmOptions, keys.data(), values.data(), 2));
             options.AppendExecutionProvider_ROCM(*rocmOptions);
+            usesRocm = true;
         }
         else if (provider == OnnxForce::ROCm)
             throw OpenMMException("ROCm execution provider is not available");
     }
 
+    // A replayed graph reads its inputs from, and writes its outputs to, the exact device buffers
+    // it was captured with, so graphs only work if we manage those buffers ourselves.
+
+    if (enableGraph == "1" && usesRocm && !usesCuda)
+        throw OpenMMException("UseGraphs is only supported with the CUDA and TensorRT execution providers");
+    useDeviceBuffers = (enableGraph == "1" && usesCuda);
+#ifndef OPENMM_ONNX_BUILD_CUDA
+    if (useDeviceBuffers)
+        throw OpenMMException("UseGraphs requires the plugin to be built with the CUDA toolkit (OPENMM_ONNX_BUILD_CUDA=ON)");
+#endif
+
     // Create the session and initialize data structures.
 
     const vector<uint8_t>& model = owner.getModel();
     session = Session(env, model.data(), model.size(), options);
-    positionVec.resize(3*particleIndices.size());
     paramVec.resize(owner.getNumGlobalParameters());
     auto memoryInfo = MemoryInfo::CreateCpu(OrtDeviceAllocator, OrtMemTypeCPU);
+
+    // When the model runs on a GPU, put the positions (and the host copies of the outputs when
+    // using graphs) in page-locked host memory so they can be transferred asynchronously.  Fall
+    // back to ordinary memory if the session does not provide a pinned allocator.
+
+    bool usePinnedMemory = false;
+    int deviceId = 0;
+    if (usesCuda) {
+        stringstream deviceStream(deviceIndex);
+        deviceStream >> deviceId;
+        if (deviceStream.fail() || !deviceStream.eof() || deviceId < 0)
+            throw OpenMMException("Illegal value for DeviceIndex: "+deviceIndex);
+        try {
+            MemoryInfo pinnedInfo("CudaPinned", OrtDeviceAllocator, deviceId, OrtMemTypeCPUOutput);
+            pinnedAllocator = Allocator(session, pinnedInfo);
+            usePinnedMemory = true;
+        }
+        catch (const Ort::Exception&) {
+        }
+    }
     int64_t positionsShape[] = {static_cast<int64_t>(particleIndices.size()), 3};
     int64_t boxShape[] = {3, 3};
     int64_t paramShape[] = {1};
-    int numInputs = 1+owner.getNumGlobalParameters();
-    if (owner.usesPeriodicBoundaryConditions())
-        numInputs++;
-    inputTensors.emplace_back(Value::CreateTensor<float>(memoryInfo, positionVec.data(), positionVec.size(), positionsShape, 2));
+    if (usePinnedMemory)
+        inputTensors.emplace_back(Value::CreateTensor<float>(pinnedAllocator, positionsShape, 2));
+    else {
+        positionVec.resize(3*particleIndices.size());
+        inputTensors.emplace_back(Value::CreateTensor<float>(memoryInfo, positionVec.data(), positionVec.size(), positionsShape, 2));
+    }
+    positionData = inputTensors[0].GetTensorMutableData<float>();
     inputNames.push_back("positions");
     if (owner.usesPeriodicBoundaryConditions()) {
         inputTensors.emplace_back(Value::CreateTensor<float>(memoryInfo, boxVectors, 9, boxShape, 2));
@@ -126,6 +198,7 @@ void OnnxForceImpl::initialize(ContextImpl& context) {
         inputTensors.emplace_back(Value::CreateTensor<float>(memoryInfo, &paramVec[i], 1, paramShape, 1));
         inputNames.push_back(owner.getGlobalParameterName(i).c_str());
     }
+    numVaryingInputs = inputTensors.size();
 
     // Process extra inputs.
 
@@ -155,6 +228,96 @@ void OnnxForceImpl::initialize(ContextImpl& context) {
         inputTensors.emplace_back(Value::CreateTensor<float>(memoryInfo, input.getValues().data(), input.getValues().size(), shape.data(), shape.size()));
         inputNames.push_back(input.getName().c_str());
     }
+
+    binding = IoBinding(session);
+    if (useDeviceBuffers) {
+        // A replayed graph writes its outputs to the buffers it was captured with, so they must
+        // have fixed shapes.  Check that the model declares shapes we can allocate in advance.
+
+        vector<int64_t> energyShape, forcesShape;
+        AllocatorWithDefaultOptions allocator;
+        for (int i = 0; i < session.GetOutputCount(); i++) {
+            string name = session.GetOutputNameAllocated(i, allocator).get();
+            if (name == "energy")
+                energyShape = session.GetOutputTypeInfo(i).GetTensorTypeAndShapeInfo().GetShape();
+            else if (name == "forces")
+                forcesShape = session.GetOutputTypeInfo(i).GetTensorTypeAndShapeInfo().GetShape();
+        }
+        int64_t energySize = 1;
+        for (int64_t dim : energyShape)
+            energySize *= (dim < 0 ? 0 : dim);
+        if (energySize != 1)
+            throw OpenMMException("UseGraphs requires the model's energy output to have a fixed shape with one element");
+        if (forcesShape.size() != 2 || (forcesShape[0] >= 0 && forcesShape[0] != (int64_t) particleIndices.size()) || forcesShape[1] != 3)
+            throw OpenMMException("UseGraphs requires the model's forces output to have shape (# particles, 3)");
+
+        // Create host buffers for the outputs, and a device copy of every tensor to bind instead.
+        // The extra inputs never change, so they only need to be copied once.
+
+        if (usePinnedMemory) {
+            outputTensors.emplace_back(Value::CreateTensor<float>(pinnedAllocator, energyShape.data(), energyShape.size()));
+            outputTensors.emplace_back(Value::CreateTensor<float>(pinnedAllocator, positionsShape, 2));
+        }
+        else {
+            energyVec.resize(1);
+            forceVec.resize(3*particleIndices.size());
+            outputTensors.emplace_back(Value::CreateTensor<float>(memoryInfo, energyVec.data(), energyVec.size(), energyShape.data(), energyShape.size()));
+            outputTensors.emplace_back(Value::CreateTensor<float>(memoryInfo, forceVec.data(), forceVec.size(), positionsShape, 2));
+        }
+        energyData = outputTensors[0].GetTensorMutableData<float>();
+        forceData = outputTensors[1].GetTensorMutableData<float>();
+        MemoryInfo deviceInfo("Cuda", OrtArenaAllocator, deviceId, OrtMemTypeDefault);
+        try {
+            deviceAllocator = Allocator(session, deviceInfo);
+        }
+        catch (const Ort::Exception& e) {
+            throw OpenMMException(string("UseGraphs could not allocate memory on the GPU: ")+e.what());
+        }
+        for (Value& tensor : inputTensors)
+            deviceInputTensors.emplace_back(createDeviceTensor(tensor));
+        for (int i = numVaryingInputs; i < inputTensors.size(); i++)
+            copyTensor(deviceInputTensors[i], inputTensors[i]);
+        for (Value& tensor : outputTensors)
+            deviceOutputTensors.emplace_back(createDeviceTensor(tensor));
+        for (int i = 0; i < inputNames.size(); i++)
+            binding.BindInput(inputNames[i], deviceInputTensors[i]);
+        binding.BindOutput("energy", deviceOutputTensors[0]);
+        binding.BindOutput("forces", deviceOutputTensors[1]);
+    }
+    else {
+        // Bind the inputs to persistent buffers.  Only bind the outputs to host memory, and let
+        // ONNX Runtime allocate them, so they can have whatever shape the model produces.
+
+        for (int i = 0; i < inputNames.size(); i++)
+            binding.BindInput(inputNames[i], inputTensors[i]);
+        binding.BindOutput("energy", memoryInfo);
+        binding.BindOutput("forces", memoryInfo);
+    }
+}
+
+Value OnnxForceImpl::createDeviceTensor(const Value& tensor) {
+    TensorTypeAndShapeInfo info = tensor.GetTensorTypeAndShapeInfo();
+    vector<int64_t> shape = info.GetShape();
+    return Value::CreateTensor(deviceAllocator, shape.data(), shape.size(), info.GetElementType());
+}
+
+void OnnxForceImpl::copyTensor(Value& dest, Value& source) {
+#ifdef OPENMM_ONNX_BUILD_CUDA
+    // Every tensor holds 32 bit values.
+
+    size_t size = source.GetTensorTypeAndShapeInfo().GetElementCount()*sizeof(float);
+    cudaError_t result = cudaMemcpy(dest.GetTensorMutableRawData(), source.GetTensorMutableRawData(), size, cudaMemcpyDefault);
+    if (result != cudaSuccess)
+        throw OpenMMException(string("Error copying tensor to or from the GPU: ")+cudaGetErrorString(result));
+#endif
+}
+
+void OnnxForceImpl::synchronizeDevice() {
+#ifdef OPENMM_ONNX_BUILD_CUDA
+    cudaError_t result = cudaDeviceSynchronize();
+    if (result != cudaSuccess)
+        throw OpenMMException(string("Error synchronizing with the GPU: ")+cudaGetErrorString(result));
+#endif
 }
 
 void OnnxForceImpl::validateInput(const string& name, const vector<int>& shape, int size) {
@@ -179,11 +342,21 @@ double OnnxForceImpl::computeForce(ContextImpl& context, const vector<Vec3>& pos
     // Pass the current state to ONNX Runtime.
 
     int numParticles = particleIndices.size();
-    for (int i = 0; i < numParticles; i++) {
-        int index = particleIndices[i];
-        positionVec[3*i] = (float) positions[index][0];
-        positionVec[3*i+1] = (float) positions[index][1];
-        positionVec[3*i+2] = (float) positions[index][2];
+    if (allParticles) {
+        // The positions are already in the order the model expects, so convert them
+        // with a single contiguous loop the compiler can vectorize.
+
+        const double* posData = reinterpret_cast<const double*>(positions.data());
+        for (int i = 0; i < 3*numParticles; i++)
+            positionData[i] = (float) posData[i];
+    }
+    else {
+        for (int i = 0; i < numParticles; i++) {
+            int index = particleIndices[i];
+            positionData[3*i] = (float) positions[index][0];
+            positionData[3*i+1] = (float) positions[index][1];
+            positionData[3*i+2] = (float) positions[index][2];
+        }
     }
     if (owner.usesPeriodicBoundaryConditions()) {
         Vec3 box[3];
@@ -197,11 +370,31 @@ double OnnxForceImpl::computeForce(ContextImpl& context, const vector<Vec3>& pos
 
     // Perform the computation.
 
-    const char* outputNames[] = {"energy", "forces"};
-    outputTensors = session.Run(RunOptions{nullptr}, inputNames.data(), inputTensors.data(), inputNames.size(), outputNames, 2);
-    const float* energy = outputTensors[0].GetTensorData<float>();
-    const float* forceData = outputTensors[1].GetTensorData<float>();
-    for (int i = 0; i < numParticles; i++)
-        forces[particleIndices[i]] = Vec3(forceData[3*i], forceData[3*i+1], forceData[3*i+2]);
-    return *energy;
+    if (useDeviceBuffers) {
+        // A copy from pageable memory can return before the transfer has finished, and the
+        // graph is replayed on ONNX Runtime's own stream, so wait for the copies to complete.
+
+        for (int i = 0; i < numVaryingInputs; i++)
+            copyTensor(deviceInputTensors[i], inputTensors[i]);
+        synchronizeDevice();
+    }
+    session.Run(runOptions, binding);
+    if (useDeviceBuffers)
+        for (int i = 0; i < outputTensors.size(); i++)
+            copyTensor(outputTensors[i], deviceOutputTensors[i]);
+    else {
+        outputTensors = binding.GetOutputValues();
+        energyData = outputTensors[0].GetTensorMutableData<float>();
+        forceData = outputTensors[1].GetTensorMutableData<float>();
+    }
+    if (allParticles) {
+        double* forceOut = reinterpret_cast<double*>(forces.data());
+        for (int i = 0; i < 3*numParticles; i++)
+            forceOut[i] = forceData[i];
+    }
+    else {
+        for (int i = 0; i < numParticles; i++)
+            forces[particleIndices[i]] = Vec3(forceData[3*i], forceData[3*i+1], forceData[3*i+2]);
+    }
+    return energyData[0];
 }
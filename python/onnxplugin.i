@@ -23,9 +23,7 @@
     uint8_t* buffer;
     Py_ssize_t length;
     PyBytes_AsStringAndSize($input, reinterpret_cast<char**>(&buffer), &length);
-    model.resize(length);
-    for (int i = 0; i < length; i++)
-        model[i] = buffer[i];
+    model.assign(buffer, buffer+length);
     $1 = &model;
 }
 
@@ -1,34 +1,79 @@
+import copy
+import functools
 import openmm as mm
 import openmm.unit as unit
 import openmmonnx
 import numpy as np
+import pathlib
 import pytest
 
+MODEL_PATH = pathlib.Path(__file__).parent.parent.parent/'tests'/'central.onnx'
+MODEL_BYTES = MODEL_PATH.read_bytes()
+FLOAT16_MODEL_BYTES = MODEL_PATH.with_name('central_fp16.onnx').read_bytes()
+
+# A System of unit mass particles that tests copy and then add forces to.
+NUM_PARTICLES = 10
+BASE_SYSTEM = mm.System()
+for _ in range(NUM_PARTICLES):
+    BASE_SYSTEM.addParticle(1.0)
+
+# Collection only needs the platform names.  Whether a platform can actually be used is checked
+# the first time a test asks for it, so each process only initializes the platforms it runs.
+PLATFORM_NAMES = [mm.Platform.getPlatform(i).getName() for i in range(mm.Platform.getNumPlatforms())]
+
+@functools.cache
+def isPlatformUsable(name):
+    system = mm.System()
+    system.addParticle(1.0)
+    try:
+        mm.Context(system, mm.VerletIntegrator(1.0), mm.Platform.getPlatformByName(name))
+    except mm.OpenMMException:
+        return False
+    return True
+
+def pytest_generate_tests(metafunc):
+    if 'platform' in metafunc.fixturenames:
+        metafunc.parametrize('platform', PLATFORM_NAMES, indirect=True)
+
+@pytest.fixture
+def platform(request):
+    if not isPlatformUsable(request.param):
+        pytest.skip(f'{request.param} platform is not available')
+    return request.param
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
+
+@pytest.fixture
+def positions(rng):
+    """ A random cloud of particles, generated directly into a preallocated array """
+    positions = np.empty((NUM_PARTICLES, 3))
+    rng.random(out=positions)
+    return positions
+
 def testConstructors():
-    model_file = '../../tests/central.onnx'
-    force = openmmonnx.OnnxForce(model_file)
-    model = open(model_file, 'rb').read()
-    assert model == force.getModel()
-    force = openmmonnx.OnnxForce(model)
+    force = openmmonnx.OnnxForce(str(MODEL_PATH))
+    assert MODEL_BYTES == force.getModel()
+    force = openmmonnx.OnnxForce(MODEL_BYTES)
     model = force.getModel()
     force = openmmonnx.OnnxForce(model)
 
 @pytest.mark.parametrize('use_cv_force', [True, False])
-@pytest.mark.parametrize('platform', [mm.Platform.getPlatform(i).getName() for i in range(mm.Platform.getNumPlatforms())])
 @pytest.mark.parametrize('particles', [[], [5,3,0]])
-def testForce(use_cv_force, platform, particles):
+# The CPU provider has no fp16 kernels for this model, so it casts back to float32 and the float16
+# case only computes in reduced precision (and needs the looser tolerances) on a GPU provider.
+@pytest.mark.parametrize('model,rtol,atol', [(MODEL_BYTES, 1e-5, 1e-8), (FLOAT16_MODEL_BYTES, 1e-2, 1e-3)], ids=['float32', 'float16'])
+def testForce(use_cv_force, platform, particles, model, rtol, atol, positions):
 
-    # Create a random cloud of particles.
-    numParticles = 10
-    system = mm.System()
-    positions = np.random.rand(numParticles, 3)
-    for _ in range(numParticles):
-        system.addParticle(1.0)
+    # Create a System for the random cloud of particles.
+    system = copy.deepcopy(BASE_SYSTEM)
 
     # Create a force
-    force = openmmonnx.OnnxForce('../../tests/central.onnx', {'UseGraphs': 'false'})
+    force = openmmonnx.OnnxForce(model, {'UseGraphs': 'false', 'GraphOptimizationLevel': 'all'})
     force.setParticleIndices(particles)
     assert force.getProperties()['UseGraphs'] == 'false'
+    assert force.getProperties()['GraphOptimizationLevel'] == 'all'
     if use_cv_force:
         # Wrap OnnxForce into CustomCVForce
         cv_force = mm.CustomCVForce('force')
@@ -39,52 +84,66 @@ def testForce(use_cv_force, platform, particles):
 
     # Compute the forces and energy.
     integ = mm.VerletIntegrator(1.0)
-    try:
-        context = mm.Context(system, integ, mm.Platform.getPlatformByName(platform))
-    except:
-        pytest.skip(f'Unable to create Context with {platform}')
+    context = mm.Context(system, integ, mm.Platform.getPlatformByName(platform))
     context.setPositions(positions)
     state = context.getState(getEnergy=True, getForces=True)
 
     # See if the energy and forces are correct.  The network defines a potential of the form E(r) = |r|^2
     if len(particles) > 0:
         positions = positions[particles]
-    expectedEnergy = np.sum(positions*positions)
-    assert np.allclose(expectedEnergy, state.getPotentialEnergy().value_in_unit(unit.kilojoules_per_mole))
+    flatPositions = positions.ravel()
+    expectedEnergy = float(flatPositions @ flatPositions)
+    expectedForces = positions * -2.0
+    assert np.allclose(expectedEnergy, state.getPotentialEnergy().value_in_unit(unit.kilojoules_per_mole), rtol=rtol, atol=atol)
     forces = state.getForces(asNumpy=True)
     if len(particles) > 0:
         forces = forces[particles]
-    assert np.allclose(-2*positions, forces)
+    assert np.allclose(expectedForces, forces, rtol=rtol, atol=atol)
 
-@pytest.mark.parametrize('platform', [mm.Platform.getPlatform(i).getName() for i in range(mm.Platform.getNumPlatforms())])
-def testInputs(platform):
+def testGraphs(rng, positions):
+    """ Test that a replayed CUDA graph sees new positions on every step """
+    system = copy.deepcopy(BASE_SYSTEM)
+    force = openmmonnx.OnnxForce(MODEL_BYTES, {'UseGraphs': 'true'})
+    force.setExecutionProvider(openmmonnx.OnnxForce.CUDA)
+    system.addForce(force)
+    try:
+        context = mm.Context(system, mm.VerletIntegrator(1.0), mm.Platform.getPlatformByName('Reference'))
+    except mm.OpenMMException as e:
+        # Only skip if graphs are unavailable.  Any other error is a failure.
+        if 'CUDA execution provider is not available' in str(e) or 'requires the plugin to be built with the CUDA toolkit' in str(e):
+            pytest.skip(str(e))
+        raise
+    for _ in range(5):
+        context.setPositions(positions)
+        state = context.getState(getEnergy=True, getForces=True)
+        flatPositions = positions.ravel()
+        expectedEnergy = float(flatPositions @ flatPositions)
+        expectedForces = positions * -2.0
+        assert np.allclose(expectedEnergy, state.getPotentialEnergy().value_in_unit(unit.kilojoules_per_mole))
+        assert np.allclose(expectedForces, state.getForces(asNumpy=True))
+        positions = positions + rng.random(positions.shape) - 0.5
 
-    # Create a random cloud of particles.
-    numParticles = 10
-    system = mm.System()
-    positions = np.random.rand(numParticles, 3)
-    for _ in range(numParticles):
-        system.addParticle(1.0)
+def testInputs(platform, rng, positions):
+
+    # Create a System for the random cloud of particles.
+    system = copy.deepcopy(BASE_SYSTEM)
 
     # Create a force
-    force = openmmonnx.OnnxForce('../../tests/inputs.onnx')
+    force = openmmonnx.OnnxForce(str(MODEL_PATH.with_name('inputs.onnx')))
     system.addForce(force)
-    scale = np.random.randint(5, size=numParticles)
-    offset = np.random.rand(numParticles)
-    force.addInput(openmmonnx.IntegerInput('scale', scale, [numParticles]))
-    force.addInput(openmmonnx.FloatInput('offset', offset, [numParticles]))
+    scale = rng.integers(5, size=NUM_PARTICLES)
+    offset = rng.random(NUM_PARTICLES)
+    force.addInput(openmmonnx.IntegerInput('scale', scale, [NUM_PARTICLES]))
+    force.addInput(openmmonnx.FloatInput('offset', offset, [NUM_PARTICLES]))
 
     # Compute the forces and energy.
     integ = mm.VerletIntegrator(1.0)
-    try:
-        context = mm.Context(system, integ, mm.Platform.getPlatformByName(platform))
-    except:
-        pytest.skip(f'Unable to create Context with {platform}')
+    context = mm.Context(system, integ, mm.Platform.getPlatformByName(platform))
     context.setPositions(positions)
     state = context.getState(getEnergy=True, getForces=True)
 
     # See if the energy and forces are correct.  The network defines a potential of the form E(r) = scale*(|r|^2-offset).
-    r2 = np.sum(positions*positions, axis=1)
+    r2 = np.einsum('ij,ij->i', positions, positions)
     expectedEnergy = np.sum(scale*(r2-offset))
     assert np.allclose(expectedEnergy, state.getPotentialEnergy().value_in_unit(unit.kilojoules_per_mole))
     forces = state.getForces(asNumpy=True)
@@ -94,16 +153,52 @@ def testInputs(platform):
     assert np.array_equal(scale, force.getInput(0).getValues())
     assert np.allclose(offset, force.getInput(1).getValues())
 
-def testProperties():
+@pytest.mark.parametrize('name,default,value', [('UseGraphs', 'false', 'true'),
+                                                ('DeviceIndex', '0', '1'),
+                                                ('GraphOptimizationLevel', 'all', 'extended'),
+                                                ('EnableMemPattern', 'true', 'false'),
+                                                ('IntraOpNumThreads', '0', '4')])
+def testProperties(name, default, value):
     """ Test that the properties are correctly set and retrieved """
-    force = openmmonnx.OnnxForce('../../tests/central.onnx')
-    force.setProperty('UseGraphs', 'true')
-    assert force.getProperties()['UseGraphs'] == 'true'
-    force.setProperty('UseGraphs', 'false')
-    assert force.getProperties()['UseGraphs'] == 'false'
+    force = openmmonnx.OnnxForce(MODEL_BYTES)
+    assert force.getProperties()[name] == default
+    force.setProperty(name, value)
+    assert force.getProperties()[name] == value
+    force.setProperty(name, default)
+    assert force.getProperties()[name] == default
+    force = openmmonnx.OnnxForce(MODEL_BYTES, {name: value})
+    assert force.getProperties()[name] == value
+
+def testSessionOptions(platform, positions):
+    """ Test that non-default session options are accepted by ONNX Runtime and give the same result """
+    system = copy.deepcopy(BASE_SYSTEM)
+    force = openmmonnx.OnnxForce(MODEL_BYTES, {'GraphOptimizationLevel': 'disable',
+                                               'EnableMemPattern': 'false',
+                                               'IntraOpNumThreads': '2'})
+    system.addForce(force)
+    context = mm.Context(system, mm.VerletIntegrator(1.0), mm.Platform.getPlatformByName(platform))
+    context.setPositions(positions)
+    state = context.getState(getEnergy=True, getForces=True)
+    flatPositions = positions.ravel()
+    expectedEnergy = float(flatPositions @ flatPositions)
+    expectedForces = positions * -2.0
+    assert np.allclose(expectedEnergy, state.getPotentialEnergy().value_in_unit(unit.kilojoules_per_mole))
+    assert np.allclose(expectedForces, state.getForces(asNumpy=True))
+
+@pytest.mark.parametrize('name,value', [('UseGraphs', 'yes'),
+                                        ('GraphOptimizationLevel', 'max'),
+                                        ('EnableMemPattern', '1'),
+                                        ('IntraOpNumThreads', '-1'),
+                                        ('IntraOpNumThreads', 'two')])
+def testIllegalProperties(name, value, platform):
+    """ Test that an illegal property value is reported when the Context is created """
+    system = copy.deepcopy(BASE_SYSTEM)
+    system.addForce(openmmonnx.OnnxForce(MODEL_BYTES, {name: value}))
+    with pytest.raises(mm.OpenMMException, match=f'Illegal value for {name}'):
+        mm.Context(system, mm.VerletIntegrator(1.0), mm.Platform.getPlatformByName(platform))
 
 def testSerialization():
-    force1 = openmmonnx.OnnxForce('../../tests/central.onnx')
+    force1 = openmmonnx.OnnxForce(MODEL_BYTES)
     xml1 = mm.XmlSerializer.serialize(force1)
     force2 = mm.XmlSerializer.deserialize(xml1)
     xml2 = mm.XmlSerializer.serialize(force2)
@@ -0,0 +1,14 @@
+import pytest
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_collection_modifyitems(config, items):
+    # When running under pytest-xdist with --dist=loadgroup, send all tests for a platform to
+    # the same worker.  Platforms are only initialized by the platform fixture when a test runs,
+    # so each worker only creates Contexts on the platforms of the groups it is given.  This must
+    # run before xdist reads the markers.
+    if not config.pluginmanager.hasplugin('xdist'):
+        return
+    for item in items:
+        callspec = getattr(item, 'callspec', None)
+        if callspec is not None and 'platform' in callspec.params:
+            item.add_marker(pytest.mark.xdist_group(name=callspec.params['platform']))
@@ -49,6 +49,8 @@ void testSerialization() {
     force.addGlobalParameter("y", 2.221);
     force.setUsesPeriodicBoundaryConditions(true);
     force.setProperty("UseGraphs", "true");
+    force.setProperty("GraphOptimizationLevel", "basic");
+    force.setProperty("IntraOpNumThreads", "2");
     force.setParticleIndices({0, 2, 4});
     force.addInput(new OnnxForce::IntegerInput("ints", {0, 1, 2, 3, 4, 5}, {2, 3}));
     force.addInput(new OnnxForce::FloatInput("floats", {2.0, 4.5, 5.3}, {1, 3}));
@@ -32,6 +32,7 @@
 #include "OnnxForce.h"
 #include "openmm/internal/AssertionUtilities.h"
 #include "openmm/Context.h"
+#include "openmm/OpenMMException.h"
 #include "openmm/Platform.h"
 #include "openmm/System.h"
 #include "openmm/VerletIntegrator.h"
@@ -215,6 +216,60 @@ void testInputs(Platform& platform) {
     ASSERT_EQUAL_TOL(expectedEnergy, state.getPotentialEnergy(), 1e-5);
 }
 
+void testGraphs() {
+    // Create a random cloud of particles.
+
+    const int numParticles = 10;
+    System system;
+    vector<Vec3> positions(numParticles);
+    OpenMM_SFMT::SFMT sfmt;
+    init_gen_rand(0, sfmt);
+    for (int i = 0; i < numParticles; i++) {
+        system.addParticle(1.0);
+        positions[i] = Vec3(genrand_real2(sfmt), genrand_real2(sfmt), genrand_real2(sfmt))*10;
+    }
+    OnnxForce* force = new OnnxForce("tests/central.onnx", {{"UseGraphs", "true"}});
+    force->setExecutionProvider(OnnxForce::CUDA);
+    system.addForce(force);
+
+    // Creating the Context fails if the CUDA execution provider is not available, or the plugin
+    // was built without the CUDA toolkit.
+
+    VerletIntegrator integ(1.0);
+    Platform& platform = Platform::getPlatformByName("Reference");
+    Context* context;
+    try {
+        context = new Context(system, integ, platform);
+    }
+    catch (const OpenMMException& e) {
+        // Only skip if graphs are unavailable.  Any other error is a failure.
+
+        string message = e.what();
+        if (message.find("CUDA execution provider is not available") == string::npos &&
+                message.find("requires the plugin to be built with the CUDA toolkit") == string::npos)
+            throw;
+        printf("Skipping testGraphs: %s\n", e.what());
+        return;
+    }
+
+    // Move the particles on every step, and check that the replayed graph sees the new positions.
+
+    for (int step = 0; step < 5; step++) {
+        context->setPositions(positions);
+        State state = context->getState(State::Energy | State::Forces);
+        double expectedEnergy = 0;
+        for (int i = 0; i < numParticles; i++) {
+            Vec3 pos = positions[i];
+            expectedEnergy += pos.dot(pos);
+            ASSERT_EQUAL_VEC(pos*(-2.0), state.getForces()[i], 1e-5);
+        }
+        ASSERT_EQUAL_TOL(expectedEnergy, state.getPotentialEnergy(), 1e-5);
+        for (int i = 0; i < numParticles; i++)
+            positions[i] += Vec3(genrand_real2(sfmt), genrand_real2(sfmt), genrand_real2(sfmt))-Vec3(0.5, 0.5, 0.5);
+    }
+    delete context;
+}
+
 void testPlatform(Platform& platform) {
     testForce(platform, {});
     testForce(platform, {0, 1, 2, 9, 5});
@@ -231,6 +286,7 @@ int main(int argc, char* argv[]) {
             printf("Testing %s\n", platform.getName().c_str());
             testPlatform(platform);
         }
+        testGraphs();
     }
     catch(const std::exception& e) {
         std::cout << "exception: " << e.what() << std::endl;
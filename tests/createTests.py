@@ -1,67 +1,109 @@
+import argparse
+import inspect
+import os
 import torch
 
+parser = argparse.ArgumentParser(description='Create the ONNX models used by the tests.')
+parser.add_argument('--force', action='store_true', help='regenerate every model, even if it is up to date')
+options = parser.parse_args()
+
+def isCurrent(f, *sources):
+    # Only regenerate a model if it is missing or older than this script or the models it is made from.
+    # Git does not preserve modification times, so report every skipped model.
+    if options.force or not os.path.exists(f):
+        return False
+    if all(os.path.getmtime(f) >= os.path.getmtime(source) for source in (__file__,)+sources):
+        print(f'Skipping {f}, which is up to date.  Use --force to regenerate it.')
+        return True
+    return False
+
+def export(model, args, f, **kwargs):
+    # Pin the opset so the models stay loadable by older versions of ONNX Runtime.  PyTorch 2.5
+    # and later default to the dynamo exporter, which writes external .onnx.data files that
+    # OnnxForce cannot load, so ask for the TorchScript exporter where the option exists.
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False
+    if not isCurrent(f):
+        torch.onnx.export(model=model, args=args, f=f, opset_version=17, **kwargs)
+
+def convertToFloat16(f, f16):
+    # Convert the internal computation to 16 bit floats, keeping 32 bit inputs and outputs.
+    if not isCurrent(f16, f):
+        import onnx
+        from onnxruntime.transformers.float16 import convert_float_to_float16
+        model = convert_float_to_float16(onnx.load(f), keep_io_types=True)
+
+        # The converter appends the Casts of the inputs after the nodes that read them.  Move
+        # them to the front so the graph is topologically sorted.
+        inputs = {i.name for i in model.graph.input}
+        nodes = list(model.graph.node)
+        inputCasts = [n for n in nodes if n.op_type == 'Cast' and n.input[0] in inputs]
+        del model.graph.node[:]
+        model.graph.node.extend(inputCasts+[n for n in nodes if n not in inputCasts])
+        onnx.checker.check_model(model)
+        onnx.save(model, f16)
+
+
 class Central(torch.nn.Module):
     def forward(self, positions):
-        positions.grad = None
         energy = torch.sum(positions*positions)
-        energy.backward()
-        forces = -positions.grad
+        forces = -2*positions
         return energy, forces
 
-torch.onnx.export(model=Central(),
-                  args=(torch.ones(1, 3, requires_grad=True),),
-                  f="central.onnx",
-                  input_names=["positions"],
-                  output_names=["energy", "forces"],
-                  dynamic_axes={"positions":[0], "forces":[0]})
+export(model=Central(),
+       args=(torch.ones(1, 3),),
+       f="central.onnx",
+       input_names=["positions"],
+       output_names=["energy", "forces"],
+       dynamic_axes={"positions":[0], "forces":[0]})
+
+convertToFloat16("central.onnx", "central_fp16.onnx")
 
 
 class Periodic(torch.nn.Module):
     def forward(self, positions, box):
-        positions.grad = None
-        boxsize = torch.diagonal(box)
-        periodicPositions = positions - torch.floor(positions/boxsize)*boxsize
+        # Take the diagonal by slicing the flattened matrix.  torch.diagonal() exports
+        # to a much larger graph.
+        boxsize = box.reshape(9)[::4]
+        periodicPositions = torch.remainder(positions, boxsize)
         energy = torch.sum(periodicPositions*periodicPositions)
-        energy.backward()
-        forces = -positions.grad
+        forces = -2*periodicPositions
         return energy, forces
 
-torch.onnx.export(model=Periodic(),
-                  args=(torch.ones(1, 3, requires_grad=True), torch.ones(3, 3)),
-                  f="periodic.onnx",
-                  input_names=["positions", "box"],
-                  output_names=["energy", "forces"],
-                  dynamic_axes={"positions":[0], "forces":[0]})
+export(model=Periodic(),
+       args=(torch.ones(1, 3), torch.ones(3, 3)),
+       f="periodic.onnx",
+       input_names=["positions", "box"],
+       output_names=["energy", "forces"],
+       dynamic_axes={"positions":[0], "forces":[0]})
 
 
 class Global(torch.nn.Module):
     def forward(self, positions, k):
-        positions.grad = None
         energy = k*torch.sum(positions*positions)
-        energy.backward()
-        forces = -positions.grad
+        forces = -2*k*positions
         return energy, forces
 
-torch.onnx.export(model=Global(),
-                  args=(torch.ones(1, 3, requires_grad=True), torch.ones(1)),
-                  f="global.onnx",
-                  input_names=["positions", "k"],
-                  output_names=["energy", "forces"],
-                  dynamic_axes={"positions":[0], "forces":[0]})
+export(model=Global(),
+       args=(torch.ones(1, 3), torch.ones(1)),
+       f="global.onnx",
+       input_names=["positions", "k"],
+       output_names=["energy", "forces"],
+       dynamic_axes={"positions":[0], "forces":[0]})
 
 
+# scale is deliberately a 32 bit integer tensor, so that this model exercises IntegerInput.
+# The Cast it adds runs on a single length N vector and is negligible.
 class Inputs(torch.nn.Module):
     def forward(self, positions, scale, offset):
-        positions.grad = None
         r = torch.sum(positions*positions, dim=1)
         energy = torch.sum(scale*(r-offset))
-        energy.backward()
-        forces = -positions.grad
+        forces = -2*scale.unsqueeze(-1)*positions
         return energy, forces
 
-torch.onnx.export(model=Inputs(),
-                  args=(torch.ones(1, 3, requires_grad=True), torch.ones(1, dtype=torch.int32), torch.ones(1)),
-                  f="inputs.onnx",
-                  input_names=["positions", "scale", "offset"],
-                  output_names=["energy", "forces"],
-                  dynamic_axes={"positions":[0], "scale":[0], "offset":[0], "forces":[0]})
+export(model=Inputs(),
+       args=(torch.ones(1, 3), torch.ones(1, dtype=torch.int32), torch.ones(1)),
+       f="inputs.onnx",
+       input_names=["positions", "scale", "offset"],
+       output_names=["energy", "forces"],
+       dynamic_axes={"positions":[0], "scale":[0], "offset":[0], "forces":[0]})